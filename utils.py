@@ -1,30 +1,34 @@
 import librosa
 import numpy as np
+import scipy.sparse
 import torch
+from contextlib import nullcontext
+from functools import lru_cache
 import torch.autograd as grad
 import torch.nn.functional as F
 
 from hparam import hparam as hp
 
-def calculate_centroid_include_self(embedding):
+@torch.jit.script
+def calculate_centroid_include_self(embedding: torch.Tensor) -> torch.Tensor:
     '''
     calculate centroid embedding. For each embedding, include itself inside the calculation.
     :param embedding: shape -> (N, M, feature_dim)
     :return:
-    embedding_mean: shape -> (M, feature_dim)
+    embedding_mean: shape -> (N, feature_dim)
     '''
-    N, M, feature_dim = embedding.shape
     embedding_mean = torch.mean(embedding, dim=1)
     return embedding_mean
 
-def calculate_centroid_exclude_self(embedding):
+@torch.jit.script
+def calculate_centroid_exclude_self(embedding: torch.Tensor) -> torch.Tensor:
     '''
     calculate centroid embedding. For each embedding, exclude itself inside the calculation.
     :param embedding: shape -> (N, M, feature_dim)
     :return:
     embedding_mean: shape -> (N, M, feature_dim)
     '''
-    N, M, feature_dim = embedding.shape
+    M = embedding.shape[1]
     embedding_sum = torch.sum(embedding, dim=1, keepdim=True) # shape -> (N, 1, feature_dim)
     embedding_mean = (embedding_sum - embedding) / (M-1)
     return embedding_mean
@@ -41,10 +45,11 @@ def calculate_similarity(embedding, centroid_embedding):
     N_c, feature_dim_c = centroid_embedding.shape
     assert N == N_c and feature_dim == feature_dim_c, "dimension wrong in get_similarity_include_self!"
 
-    centroid_embedding = centroid_embedding.unsqueeze(0).unsqueeze(0).expand(N, M, -1, -1)
-    assert centroid_embedding.shape == (N, M, N, feature_dim), "centroid embedding has wrong expansion in get_similarity_include_self."
-    embedding = embedding.unsqueeze(2)
-    similarity = F.cosine_similarity(embedding, centroid_embedding, dim=3)
+    # cosine similarity of normalized vectors is their inner product, so all
+    # (utterance, centroid) pairs come from one matmul instead of an (N, M, N, feature_dim) expansion
+    embedding = F.normalize(embedding.reshape(N * M, feature_dim), dim=1)
+    centroid_embedding = F.normalize(centroid_embedding, dim=1)
+    similarity = torch.mm(embedding, centroid_embedding.t()).view(N, M, N)
     return similarity
 
 def calculate_similarity_j_equal_k(embedding, centroid_embedding):
@@ -63,21 +68,34 @@ def calculate_similarity_j_equal_k(embedding, centroid_embedding):
     return similarity
 
 def combine_similarity(similarity, similarity_j_equal_k):
-    same_index = list(range(similarity.shape[0]))
-    similarity[same_index, :, same_index] = similarity_j_equal_k[same_index, :]
+    # the (dim 0, dim 2) diagonal of similarity has shape (M, N)
+    similarity = torch.diagonal_scatter(similarity, similarity_j_equal_k.t(), dim1=0, dim2=2)
     return similarity
 
-def get_similarity(embedding):
+def _similarity_autocast(tensor, similarity_precision):
+    '''
+    autocast context for the similarity matmuls. Only cuda has tensor cores to gain from,
+    so anywhere else (or with similarity_precision=None) everything stays in the input dtype.
+    '''
+    if similarity_precision is None or not tensor.is_cuda:
+        return nullcontext()
+    return torch.autocast('cuda', dtype=similarity_precision)
+
+def get_similarity(embedding, similarity_precision=torch.float16):
     '''
     get similarity for input embedding
     :param embedding: shape -> (N, M, feature)
+    :param similarity_precision: dtype of the centroid similarity matmul on cuda, None to keep the input dtype
     :return:
-    similarity: shape -> (N, M, N)
+    similarity: shape -> (N, M, N), same dtype as embedding
     '''
     embedding_mean_include = calculate_centroid_include_self(embedding)
     embedding_mean_exclude = calculate_centroid_exclude_self(embedding)
 
-    similarity = calculate_similarity(embedding, embedding_mean_include) # shape (N, M, N)
+    with _similarity_autocast(embedding, similarity_precision):
+        similarity = calculate_similarity(embedding, embedding_mean_include) # shape (N, M, N)
+    # autocast output comes back in similarity_precision, the losses run in the input dtype
+    similarity = similarity.to(embedding.dtype)
     similarity_j_equal_k = calculate_similarity_j_equal_k(embedding, embedding_mean_exclude) # shape (N, M)
     similarity = combine_similarity(similarity, similarity_j_equal_k)
     return similarity
@@ -104,13 +122,13 @@ def get_contrast_loss(similarity):
     loss = sum_ji(L(e_ji))
     '''
 
-    # some inplace operation
-    # one of the variables needed for gradient computation has been modified by an inplace operation
-    # so I choose to implement myself
-    sigmoid = 1 / (1 + torch.exp(-similarity))
-    same_index = list(range(similarity.shape[0]))
-    loss_1 = torch.sum(1-sigmoid[same_index, :, same_index])
-    sigmoid[same_index, :, same_index] = 0
+    N = similarity.shape[0]
+    sigmoid = torch.sigmoid(similarity)
+    # j == k entries, shape -> (M, N)
+    loss_1 = torch.sum(1 - torch.diagonal(sigmoid, dim1=0, dim2=2))
+    # mask out j == k out of place so autograd still sees the original sigmoid
+    same_mask = torch.eye(N, dtype=torch.bool, device=similarity.device).unsqueeze(1) # shape -> (N, 1, N)
+    sigmoid = sigmoid.masked_fill(same_mask, 0)
     loss_2 = torch.sum(torch.max(sigmoid, dim=2)[0])
 
     loss = loss_1 + loss_2
@@ -123,16 +141,41 @@ def get_softmax_loss(similarity):
     :return:
     loss = sum_ji(L(e_ji))
     '''
-    same_index = list(range(similarity.shape[0]))
-    loss = torch.sum(torch.log(torch.sum(torch.exp(similarity), dim=2) + 1e-6)) - torch.sum(similarity[same_index, :, same_index])
+    # logsumexp is stable for large S_jik, where exp() would overflow
+    loss = torch.sum(torch.logsumexp(similarity, dim=2)) - torch.sum(torch.diagonal(similarity, dim1=0, dim2=2))
     return loss
 
-def normalize_0_1(values, max_value, min_value):
-    normalized = np.clip((values - min_value) / (max_value - min_value), 0, 1)
+def _float_dtype(*args):
+    # dtype the out-of-place arithmetic would give, with integers promoted to float64 like true division
+    dtype = np.result_type(*args)
+    return dtype if np.issubdtype(dtype, np.inexact) else np.dtype(np.float64)
+
+def normalize_0_1(values, max_value, min_value, out=None):
+    if not isinstance(values, np.ndarray):
+        # scalars and torch tensors keep the out-of-place expression (and their type)
+        return np.clip((values - min_value) / (max_value - min_value), 0, 1)
+    # subtract straight into the float buffer (out= if given), then scale and clip in place
+    normalized = np.subtract(values, min_value, out=out, dtype=_float_dtype(values, min_value, max_value))
+    normalized /= max_value - min_value
+    np.clip(normalized, 0, 1, out=normalized)
     return normalized
 
+@lru_cache(maxsize=8)
+def _mel_basis(sr, n_fft, n_mels, fmin=0.0, fmax=None):
+    # the filterbank only depends on these arguments, so build it once per setting
+    return librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels, fmin=fmin, fmax=fmax)
+
+@lru_cache(maxsize=8)
+def _mel_basis_sparse(sr, n_fft, n_mels, fmin=0.0, fmax=None):
+    # each triangular filter only covers a few FFT bins, so most of the basis is zeros
+    return scipy.sparse.csr_matrix(_mel_basis(sr, n_fft, n_mels, fmin=fmin, fmax=fmax))
+
+@lru_cache(maxsize=8)
+def _dct_basis(n_filters, n_input):
+    return librosa.filters.dct(n_filters, n_input)
+
 def mfccs_and_spec(wav_file, wav_process = False, calc_mfccs=False, calc_mag_db=False):    
-    sound_file, _ = librosa.core.load(wav_file, sr=hp.data.sr)
+    sound_file, _ = load_audio(wav_file, sr=hp.data.sr)
     window_length = int(hp.data.window*hp.data.sr)
     hop_length = int(hp.data.hop*hp.data.sr)
     duration = hp.data.tisv_frame * hp.data.hop + hp.data.window
@@ -146,8 +189,8 @@ def mfccs_and_spec(wav_file, wav_process = False, calc_mfccs=False, calc_mag_db=
     spec = librosa.stft(sound_file, n_fft=hp.data.nfft, hop_length=hop_length, win_length=window_length)
     mag_spec = np.abs(spec)
     
-    mel_basis = librosa.filters.mel(hp.data.sr, hp.data.nfft, n_mels=hp.data.nmels)
-    mel_spec = np.dot(mel_basis, mag_spec)
+    mel_basis = _mel_basis_sparse(hp.data.sr, hp.data.nfft, hp.data.nmels)
+    mel_spec = mel_basis @ mag_spec
     
     mag_db = librosa.amplitude_to_db(mag_spec)
     #db mel spectrogram
@@ -155,35 +198,16 @@ def mfccs_and_spec(wav_file, wav_process = False, calc_mfccs=False, calc_mag_db=
     
     mfccs = None
     if calc_mfccs:
-        mfccs = np.dot(librosa.filters.dct(40, mel_db.shape[0]), mel_db).T
+        mfccs = np.dot(_dct_basis(40, mel_db.shape[0]), mel_db).T
     
     return mfccs, mel_db, mag_db
 
-def get_centroids(embeddings):
-    centroids = embeddings.mean(dim=1)
-    return centroids
+# get_centroids returns the speaker centroids and get_utterance_centroids the
+# per utterance centroids without that utterance; both are the scripted helpers above
+get_centroids = calculate_centroid_include_self
+get_utterance_centroids = calculate_centroid_exclude_self
 
-def get_utterance_centroids(embeddings):
-    """
-    Returns the centroids for each utterance of a speaker, where
-    the utterance centroid is the speaker centroid without considering
-    this utterance
-
-    Shape of embeddings should be:
-        (speaker_ct, utterance_per_speaker_ct, embedding_size)
-    """
-    sum_centroids = embeddings.sum(dim=1)
-    # we want to subtract out each utterance, prior to calculating the
-    # the utterance centroid
-    sum_centroids = sum_centroids.reshape(
-        sum_centroids.shape[0], 1, sum_centroids.shape[-1]
-    )
-    # we want the mean but not including the utterance itself, so -1
-    num_utterances = embeddings.shape[1] - 1
-    centroids = (sum_centroids - embeddings) / num_utterances
-    return centroids
-
-def get_cossim(embeddings, centroids):
+def get_cossim(embeddings, centroids, similarity_precision=torch.float16):
     # number of utterances per speaker
     num_utterances = embeddings.shape[1]
     utterance_centroids = get_utterance_centroids(embeddings)
@@ -198,26 +222,26 @@ def get_cossim(embeddings, centroids):
         embeddings.shape[0] * num_utterances,
         -1
     )
+    # normalize once up front so every cosine similarity below reduces to a
+    # plain inner product
+    embeddings_flat = F.normalize(embeddings_flat, dim=1)
+    utterance_centroids_flat = F.normalize(utterance_centroids_flat, dim=1)
+    centroids_norm = F.normalize(centroids, dim=1)
+
     # the cosine distance between utterance and the associated centroids
     # for that utterance
     # this is each speaker's utterances against his own centroid, but each
     # comparison centroid has the current utterance removed
-    cos_same = F.cosine_similarity(embeddings_flat, utterance_centroids_flat)
+    cos_same = torch.sum(embeddings_flat * utterance_centroids_flat, dim=1)
 
     # now we get the cosine distance between each utterance and the other speakers'
     # centroids
-    # to do so requires comparing each utterance to each centroid. To keep the
-    # operation fast, we vectorize by using matrices L (embeddings) and
-    # R (centroids) where L has each utterance repeated sequentially for all
-    # comparisons and R has the entire centroids frame repeated for each utterance
-    centroids_expand = centroids.repeat((num_utterances * embeddings.shape[0], 1)) # (M*N, E)
-    embeddings_expand = embeddings_flat.unsqueeze(1).repeat(1, embeddings.shape[0], 1) # (M*N, 1, E) -> (M*N, M, E)
-    embeddings_expand = embeddings_expand.view(
-        embeddings_expand.shape[0] * embeddings_expand.shape[1],
-        embeddings_expand.shape[-1]
-    )
-    cos_diff = F.cosine_similarity(embeddings_expand, centroids_expand)
-    cos_diff = cos_diff.view(
+    # comparing each utterance to each centroid is a single matmul of the
+    # normalized embeddings (M*N, E) with the normalized centroids (N, E),
+    # so no (M*N*N, E) expansion has to be materialized
+    with _similarity_autocast(embeddings, similarity_precision):
+        cos_diff = torch.mm(embeddings_flat, centroids_norm.t())
+    cos_diff = cos_diff.to(embeddings.dtype).view(
         embeddings.size(0),
         num_utterances,
         centroids.size(0)
@@ -260,18 +284,40 @@ def mel_spectrogram(wav, hp):
     S = librosa.core.stft(y=wav, n_fft=hp.data.nfft,
                                 win_length=int(hp.data.window * hp.data.sr), hop_length=int(hp.data.hop * hp.data.sr))
     S = np.abs(S)
-    mel_basis = librosa.filters.mel(sr=hp.data.sr, n_fft=hp.data.nfft, n_mels=hp.data.nmels, fmin=55, fmax=8000)
-    S = np.dot(mel_basis, S)
-    S = np.clip(S, 1e-5, None)
-    S = np.log(S)
+    mel_basis = _mel_basis_sparse(hp.data.sr, hp.data.nfft, hp.data.nmels, fmin=55, fmax=8000)
+    S = mel_basis @ S
+    # clip and log in place on the fresh matmul output rather than allocating twice
+    np.maximum(S, 1e-5, out=S)
+    np.log(S, out=S)
+    return S
+
+def mel_spectrogram_batch(wavs, hp):
+    '''
+    batched torch version of mel_spectrogram, runs on the device wavs live on
+    :param wavs: shape -> (B, T), tensor or array of equal length waveforms
+    :return:
+    S: shape -> (B, n_mels, frames)
+    '''
+    wavs = torch.as_tensor(wavs)
+    win_length = int(hp.data.window * hp.data.sr)
+    window = torch.hann_window(win_length, dtype=wavs.dtype, device=wavs.device)
+    S = torch.stft(wavs, n_fft=hp.data.nfft, hop_length=int(hp.data.hop * hp.data.sr), win_length=win_length,
+                   window=window, center=True, pad_mode='constant', return_complex=True)
+    S = torch.abs(S)
+    mel_basis = _mel_basis(hp.data.sr, hp.data.nfft, hp.data.nmels, fmin=55, fmax=8000)
+    mel_basis = torch.as_tensor(mel_basis, dtype=S.dtype, device=S.device)
+    S = torch.matmul(mel_basis, S)
+    S = S.clamp_min_(1e-5).log_()
     return S
 
 def mel_spectrogram_old(wav):
     S = librosa.core.stft(y=wav, n_fft=hp.data.nfft,
                                 win_length=int(hp.data.window * hp.data.sr), hop_length=int(hp.data.hop * hp.data.sr))
     S = np.abs(S) ** 2
-    mel_basis = librosa.filters.mel(sr=hp.data.sr, n_fft=hp.data.nfft, n_mels=hp.data.nmels)
-    S = np.log10(np.dot(mel_basis, S) + 1e-6)           # log mel 
+    mel_basis = _mel_basis_sparse(hp.data.sr, hp.data.nfft, hp.data.nmels)
+    S = mel_basis @ S
+    S += 1e-6
+    np.log10(S, out=S)           # log mel 
     return S
 
 if __name__ == "__main__":
@@ -289,7 +335,7 @@ import numpy as np
 from pathlib import Path
 from typing import Optional, Union
 import librosa
-import struct
+import torch
 from params import *
 from scipy.signal import lfilter
 import soundfile as sf
@@ -318,7 +364,7 @@ def preprocess_wav(fpath_or_wav: Union[str, Path, np.ndarray],
     """
     # Load the wav from disk if needed
     if isinstance(fpath_or_wav, str) or isinstance(fpath_or_wav, Path):
-        wav, source_sr = librosa.load(str(fpath_or_wav), sr=None)
+        wav, source_sr = load_audio(fpath_or_wav)
     else:
         wav = fpath_or_wav
 
@@ -348,23 +394,22 @@ def trim_long_silences(wav):
     wav = wav[:len(wav) - (len(wav) % samples_per_window)]
 
     # Convert the float waveform to 16-bit mono PCM
-    pcm_wave = struct.pack("%dh" % len(wav), *(np.round(wav * int16_max)).astype(np.int16))
+    pcm_wave = np.round(wav * int16_max).astype(np.int16).tobytes()
 
-    # Perform voice activation detection
+    # Perform voice activation detection, slicing a memoryview so that no window is copied
+    pcm_view = memoryview(pcm_wave)
     voice_flags = []
     vad = webrtcvad.Vad(mode=3)
     for window_start in range(0, len(wav), samples_per_window):
         window_end = window_start + samples_per_window
-        voice_flags.append(vad.is_speech(pcm_wave[window_start * 2:window_end * 2],
+        voice_flags.append(vad.is_speech(pcm_view[window_start * 2:window_end * 2],
                                          sample_rate=sample_rate))
-    voice_flags = np.array(voice_flags)
+    voice_flags = np.array(voice_flags, dtype=np.float32)
 
     # Smooth the voice detection with a moving average
     def moving_average(array, width):
         array_padded = np.concatenate((np.zeros((width - 1) // 2), array, np.zeros(width // 2)))
-        ret = np.cumsum(array_padded, dtype=float)
-        ret[width:] = ret[width:] - ret[:-width]
-        return ret[width - 1:] / width
+        return np.convolve(array_padded, np.ones(width) / width, mode='valid')
 
     audio_mask = moving_average(voice_flags, vad_moving_average_width)
     audio_mask = np.round(audio_mask).astype(np.bool)
@@ -386,20 +431,47 @@ def normalize_volume(wav, target_dBFS, increase_only=False, decrease_only=False)
 
 
 def ls(path):
-    return os.popen('ls %s'%path).read().split('\n')[:-1]
+    # same listing as the shell's ls (sorted, no hidden files) without spawning a subprocess
+    return sorted(entry.name for entry in os.scandir(path) if not entry.name.startswith('.'))
 
 def label_2_float(x, bits):
-    return 2 * x / (2**bits - 1.) - 1.
+    y = x * 2.
+    y /= 2**bits - 1.
+    y -= 1.
+    return y
 
 
 def float_2_label(x, bits):
     assert abs(x).max() <= 1.0
-    x = (x + 1.) * (2**bits - 1) / 2
-    return x.clip(0, 2**bits - 1)
+    y = x + 1.
+    y *= (2**bits - 1) / 2
+    if isinstance(y, np.ndarray):
+        return np.clip(y, 0, 2**bits - 1, out=y)
+    # numpy scalars and torch tensors have no out= on clip
+    return y.clip(0, 2**bits - 1)
+
+
+def load_audio(path, sr=None):
+    """
+    Drop-in for librosa.load(path, sr=sr): decodes with soundfile, which is much faster
+    than librosa's audioread path, and only resamples when the file's rate differs from sr.
+    Falls back to librosa.load for formats libsndfile cannot read.
+    """
+    try:
+        wav, source_sr = sf.read(str(path), dtype='float32')
+    except RuntimeError:
+        return librosa.load(str(path), sr=sr)
+    # librosa.load downmixes to mono by default
+    if wav.ndim > 1:
+        wav = wav.mean(axis=1)
+    if sr is not None and source_sr != sr:
+        wav = librosa.resample(wav, orig_sr=source_sr, target_sr=sr)
+        source_sr = sr
+    return wav, source_sr
 
 
 def load_wav(path):
-    return librosa.load(path, sr=sample_rate)[0]
+    return load_audio(path, sr=sample_rate)[0]
 
 
 def save_wav(x, path):
@@ -408,13 +480,18 @@ def save_wav(x, path):
 
 def split_signal(x):
     unsigned = x + 2**15
-    coarse = unsigned // 256
-    fine = unsigned % 256
+    if not isinstance(unsigned, np.ndarray):
+        # Python ints and torch tensors keep their own type
+        return unsigned // 256, unsigned % 256
+    # quotient and remainder in one pass
+    coarse, fine = np.divmod(unsigned, 256)
     return coarse, fine
 
 
 def combine_signal(coarse, fine):
-    return coarse * 256 + fine - 2**15
+    x = coarse * 256 + fine
+    x -= 2**15
+    return x
 
 
 def encode_16bits(x):
@@ -422,15 +499,23 @@ def encode_16bits(x):
 
 
 def linear_to_mel(spectrogram):
-    return librosa.feature.melspectrogram(
-        S=spectrogram, sr=sample_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin)
-
-def normalize(S):
-    return np.clip((S - min_level_db) / -min_level_db, 0, 1)
-
-
-def denormalize(S):
-    return (np.clip(S, 0, 1) * -min_level_db) + min_level_db
+    return _mel_basis_sparse(sample_rate, n_fft, num_mels, fmin=fmin) @ spectrogram
+
+def normalize(S, out=None):
+    if not isinstance(S, np.ndarray):
+        # scalars and torch tensors keep the out-of-place expression (and their type)
+        return np.clip((S - min_level_db) / -min_level_db, 0, 1)
+    # subtract straight into the float buffer (out= if given), then scale and clip in place
+    S = np.subtract(S, min_level_db, out=out, dtype=_float_dtype(S, min_level_db))
+    S /= -min_level_db
+    return np.clip(S, 0, 1, out=S)
+
+
+def denormalize(S, out=None):
+    S = np.clip(S, 0, 1, out=out)
+    S *= -min_level_db
+    S += min_level_db
+    return S
 
 
 def amp_to_db(x):
@@ -460,7 +545,11 @@ def stft(y):
 
 
 def pre_emphasis(x):
-    return lfilter([1, -preemphasis], [1], x)
+    # 1-tap FIR y[t] = x[t] - preemphasis * x[t-1], no need for a general lfilter
+    y = np.empty(len(x))
+    y[0] = x[0]
+    np.subtract(x[1:], preemphasis * x[:-1], out=y[1:])
+    return y
 
 
 def de_emphasis(x):
@@ -469,15 +558,36 @@ def de_emphasis(x):
 
 def encode_mu_law(x, mu):
     mu = mu - 1
-    fx = np.sign(x) * np.log(1 + mu * np.abs(x)) / np.log(1 + mu)
-    return np.floor((fx + 1) / 2 * mu + 0.5)
+    if not isinstance(x, np.ndarray):
+        # scalars and torch tensors keep the out-of-place expression (and their type)
+        fx = np.sign(x) * np.log(1 + mu * np.abs(x)) / np.log(1 + mu)
+        return np.floor((fx + 1) / 2 * mu + 0.5)
+    # same expression, evaluated in place in a single float64 working buffer
+    fx = np.abs(x, dtype=np.float64)
+    fx *= mu
+    fx += 1
+    np.log(fx, out=fx)
+    fx *= np.sign(x)
+    fx /= np.log(1 + mu)
+    fx += 1
+    fx *= mu / 2
+    fx += 0.5
+    return np.floor(fx, out=fx)
 
 
 def decode_mu_law(y, mu, from_labels=True):
     # TODO: get rid of log2 - makes no sense
     if from_labels: y = label_2_float(y, math.log2(mu))
     mu = mu - 1
-    x = np.sign(y) / mu * ((1 + mu) ** np.abs(y) - 1)
+    if not isinstance(y, np.ndarray):
+        # scalars and torch tensors keep the out-of-place expression (and their type)
+        return np.sign(y) / mu * ((1 + mu) ** np.abs(y) - 1)
+    # same expression, evaluated in place in a single working buffer of the input's float dtype
+    x = np.abs(y, dtype=np.result_type(y, np.float32))
+    np.power(1 + mu, x, out=x)
+    x -= 1
+    x *= np.sign(y)
+    x /= mu
     return x
 
 def reconstruct_waveform(mel, n_iter=32):
@@ -493,6 +603,36 @@ def reconstruct_waveform(mel, n_iter=32):
         hop_length=hop_length, win_length=win_length)
     return wav
 
+def griffinlim_batch(S, n_iter=32, momentum=0.99):
+    """Batched torch port of librosa's fast Griffin-Lim, run on the device of
+    the (batch, 1 + n_fft/2, frames) magnitude tensor S."""
+    window = torch.hann_window(win_length, dtype=S.dtype, device=S.device)
+    def _stft(y):
+        return torch.stft(y, n_fft=n_fft, hop_length=hop_length, win_length=win_length,
+                          window=window, center=True, pad_mode='constant', return_complex=True)
+    def _istft(D):
+        return torch.istft(D, n_fft=n_fft, hop_length=hop_length, win_length=win_length,
+                           window=window, center=True)
+
+    angles = torch.exp(2j * math.pi * torch.rand(S.shape, dtype=S.dtype, device=S.device))
+    rebuilt = torch.zeros_like(angles)
+    for _ in range(n_iter):
+        tprev = rebuilt
+        rebuilt = _stft(_istft(S * angles))
+        angles = rebuilt - (momentum / (1 + momentum)) * tprev
+        angles = angles / (torch.abs(angles) + 1e-16)
+    return _istft(S * angles)
+
+def reconstruct_waveform_batch(mels, n_iter=32, device='cpu'):
+    """Same as reconstruct_waveform for a batch of mels, running Griffin-Lim
+    once for the whole batch on the given device."""
+    S = np.stack([librosa.feature.inverse.mel_to_stft(
+        db_to_amp(denormalize(mel)), power=1, sr=sample_rate,
+        n_fft=n_fft, fmin=fmin) for mel in mels])
+    S = torch.as_tensor(S, dtype=torch.float32, device=device)
+    wavs = griffinlim_batch(S, n_iter=n_iter)
+    return wavs.cpu().numpy()
+
 def to_numpy(batch):
     batch = batch.detach().cpu().numpy()
     batch = np.squeeze(batch)
@@ -570,16 +710,18 @@ def plot_batch_eval(modelname, direction, batchno, SRC, fake_TRGT):
         
         
 def wav_batch_eval(modelname, direction, batchno, SRC, fake_TRGT):
+    device = SRC.device
     SRC, fake_TRGT = to_numpy(SRC), to_numpy(fake_TRGT)
+    # reconstruct the whole batch, inputs and outputs, in one Griffin-Lim run
+    wavs = reconstruct_waveform_batch(np.concatenate((SRC, fake_TRGT)), device=device)
+    REF, OUT = wavs[:len(SRC)], wavs[len(SRC):]
     i = 1
-    for src, fake_target in zip(SRC, fake_TRGT):
+    for ref, out in zip(REF, OUT):
         name = "out_eval/%s/%s/%s_%04d_%s"%(modelname, direction, direction, batchno, i)
         
-        ref = reconstruct_waveform(src)
         ref_fname = name + '_ref.wav'
         sf.write(ref_fname, ref, sample_rate)
         
-        out = reconstruct_waveform(fake_target)
         out_fname = name + '_out.wav'
         sf.write(out_fname, out, sample_rate)
         i += 1